@@ -46,7 +46,7 @@ SUPPORTED_EXTS = {".txt", ".md", ".json", ".jsonl"}
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "text-embedding-3-small")
 OPENAI_DIM = int(os.getenv("OPENAI_DIM", "256"))
 PREPROC_VER = 2
-CHUNKER_VER = 4
+CHUNKER_VER = 5
 VERSION_KEY = f"{OPENAI_MODEL}:{OPENAI_DIM}:p{PREPROC_VER}:c{CHUNKER_VER}"
 
 # Global debug flag (set by CLI)
@@ -35,8 +35,8 @@ def _content_sig(file_path):
     return hasher.hexdigest()
 
 def _text_hash(text):
-    """Hash for text chunks - 16-byte binary MD5 for space efficiency"""
-    return hashlib.md5(text.encode('utf-8')).digest()  # Binary instead of hex
+    """Hash for text chunks - 16-byte binary SHA-256 prefix (SHA-NI accelerated via OpenSSL)"""
+    return hashlib.sha256(text.encode('utf-8')).digest()[:16]  # Binary instead of hex
 
 def _get_file_cache_key(path):
     """Fast cache key for file stats"""
@@ -83,6 +83,7 @@ def _init_db():
     
     con = sqlite3.connect(KB_DB, check_same_thread=False, timeout=30)
     con.executescript("""
+        PRAGMA page_size=4096;
         PRAGMA journal_mode=WAL;
         PRAGMA synchronous=NORMAL;
         PRAGMA temp_store=MEMORY;
@@ -1,6 +1,6 @@
-import os, re, time, sqlite3, json, numpy as np, hashlib, unicodedata
-from collections import OrderedDict
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import os, re, time, sqlite3, json, base64, numpy as np, unicodedata
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
 
 import kb_config  # ensures mode-specific env behavior is applied
@@ -18,6 +18,9 @@ K_SQL = int(os.getenv("KB_K_SQL", 600))
 K_FINAL = int(os.getenv("KB_K_FINAL", 20))
 TOP_OAI = int(os.getenv("KB_TOP_OAI", 28))
 OAI_TIMEOUT = float(os.getenv("OAI_TIMEOUT", 2.0))
+# Inputs per embeddings request: the API caps a request at 2048 inputs and 300k tokens,
+# and ~220-word spans run ~300 tokens each, so the token cap binds first
+OAI_BATCH = int(os.getenv("OAI_BATCH", 768))
 JACCARD_THRESHOLD = float(os.getenv("JACCARD_THRESHOLD", 0.83))
 RRF_K = int(os.getenv("RRF_K", 60))
 
@@ -38,11 +41,25 @@ STOP = {
 }
 
 # Tokenizer function from search_module.py
-tok = lambda s: re.findall(r"[a-z0-9]+", (s or "").lower())
+_TOK_RE = re.compile(r"[a-z0-9]+")
+tok = lambda s: _TOK_RE.findall((s or "").lower())
+
+# Precompiled patterns for the per-query / per-doc hot paths
+_NUM_TOKEN_RE = re.compile(r"\d+(\.\d+)?")
+_NUM_RE = re.compile(r"\b\d+\b")
+_YEAR_RE = re.compile(r"\b\d{4}\b")
+_DIGITS_RE = re.compile(r"\d+")
+_CODE_RE = re.compile(r"\d{3,4}")
+_SENT_SPLIT_RE = re.compile(r"(?<=[.!?])\s+")
+_PHRASE_PATS = [re.compile(p) for p in (
+    r'"([^"]+)"',
+    r"'([^']+)'",
+    r"[\u2018\u2019\u201c\u201d]([^\u2018\u2019\u201c\u201d]+)[\u2018\u2019\u201c\u201d]",
+)]
 
 def _keywords(q, max_terms=16):  # ENHANCED: Like ace code
     terms = tok(q)
-    nums = [t for t in terms if re.fullmatch(r"\d+(\.\d+)?", t)]
+    nums = [t for t in terms if _NUM_TOKEN_RE.fullmatch(t)]
     words = [t for t in terms if t not in nums and t not in STOP and len(t) > 2]
     words = sorted(set(words), key=lambda x: (-len(x), x))[:max_terms]
     return list(dict.fromkeys(nums + words))
@@ -53,7 +70,7 @@ def _fts_or(keys):
         return None
     parts = []
     for k in keys:
-        if re.fullmatch(r"\d+(\.\d+)?", k):
+        if _NUM_TOKEN_RE.fullmatch(k):
             parts.append(k)  # Numbers as-is
         else:
             parts.append(f'"{k}"')  # Words in quotes
@@ -85,8 +102,8 @@ def _detect_phrases(q):
     phrases = []
     
     # Extract quoted phrases (all quote types)  
-    for pattern in [r'"([^"]+)"', r"'([^']+)'", r"'([^']+)'", r"'([^']+)'"]:
-        phrases.extend(re.findall(pattern, q))
+    for pattern in _PHRASE_PATS:
+        phrases.extend(pattern.findall(q))
     
     # GENERIC: Detect common bigrams from query itself (no hardcoding)
     words = tok(q)
@@ -105,48 +122,49 @@ def _detect_phrases(q):
     return list(set(phrases))  # dedupe
 
 def _snippet(text, query, max_chars=280):  # FAST: Like search_module
-    sents = re.split(r'(?<=[.!?])\s+', text)
+    sents = _SENT_SPLIT_RE.split(text)
     if not sents: return (text[:max_chars] + ("…" if len(text) > max_chars else ""))
-    qt = set(tok(query))
-    best = max(range(len(sents)), key=lambda i: sum(w in sents[i].lower() for w in qt))
+    qt = list(set(tok(query)))
+    # Lowercase each sentence once, not once per query word (substring match kept)
+    hits = [sum(1 for w in qt if w in sl) for sl in map(str.lower, sents)]
+    best = hits.index(max(hits))
     left, right = max(0, best-1), min(len(sents), best+3)
     out = " ".join(sents[left:right])
     return (out[:max_chars].rsplit(" ", 1)[0] + "…") if len(out) > max_chars else out
 
 def _minmax(xs):
     if xs is None or len(xs) == 0: 
-        return []
-    if isinstance(xs, (list, tuple)):
-        xs = np.array(xs)
-    lo, hi = np.min(xs), np.max(xs)
-    return [0.5] * len(xs) if hi - lo < 1e-9 else [(x - lo) / (hi - lo) for x in xs]
+        return np.zeros(0)
+    xs = np.asarray(xs, dtype=float)
+    lo, hi = xs.min(), xs.max()
+    return np.full_like(xs, 0.5) if hi - lo < 1e-9 else (xs - lo) / (hi - lo)
+
+_time = time.time
 
 class LRU:
+    """TTL'd LRU on a plain dict: insertion order doubles as recency order"""
     def __init__(self, cap=2048, ttl=600):
-        self.cap, self.ttl, self.d = cap, ttl, OrderedDict()
+        self.cap, self.ttl, self.d = cap, ttl, {}
     
     def get(self, k):
-        v = self.d.get(k)
-        if not v: return None
+        v = self.d.pop(k, None)
+        if v is None: return None
         vec, ts = v
-        if time.time() - ts > self.ttl:
-            self.d.pop(k, None)
+        if _time() - ts > self.ttl:
             return None
-        self.d.move_to_end(k)
+        self.d[k] = v  # re-insert = move to end
         return vec
     
     def put(self, k, v):
-        self.d[k] = (v, time.time())
-        self.d.move_to_end(k)
-        if len(self.d) > self.cap:
-            self.d.popitem(last=False)
+        d = self.d
+        d.pop(k, None)
+        d[k] = (v, _time())
+        if len(d) > self.cap:
+            del d[next(iter(d))]
 
 OAI_Q_CACHE = LRU(512, ttl=900)  
 OAI_D_CACHE = LRU(8192, ttl=3600)  
 
-def _text_hash(text):
-    return hashlib.md5(text.encode('utf-8')).digest()  # Binary to match kb_store
-
 
 
 # DB & OPENAI - Dynamic connection
@@ -156,72 +174,79 @@ def _get_db_connection(db_path=None):
     if db_path is None:
         db_path = kb_store.get_db_path()
     con = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
-    con.execute("PRAGMA busy_timeout=30000")
+    # Read-heavy: WAL lets readers run alongside the cache writer; mmap skips per-page read syscalls
+    con.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA cache_size=-65536;
+        PRAGMA busy_timeout=30000;
+    """)
     return con
 
 def _cli():
     global _client
     if _client is None:
-        _client = OpenAI()
+        # No retries: a failed/throttled call falls back to BM25-only instead of blocking.
+        # httpx applies timeout per phase; _oai_embed enforces the wall-clock bound.
+        _client = OpenAI(timeout=OAI_TIMEOUT, max_retries=0)
     return _client
 
+# Reused across queries for embedding calls (no per-call executor/thread spin-up)
+_EMBED_WORKERS = 4
+_EMBED_POOL = ThreadPoolExecutor(max_workers=_EMBED_WORKERS)
+
+def _unit_rows(data):
+    """Decode base64 fp32 embeddings into a preallocated matrix and L2-normalize rows in place"""
+    V = np.empty((len(data), OPENAI_DIM), dtype=np.float32)
+    for i, d in enumerate(data):
+        V[i] = np.frombuffer(base64.b64decode(d.embedding), dtype=np.float32)
+    V *= (1.0 / (np.sqrt(np.einsum('ij,ij->i', V, V)) + 1e-9))[:, None]
+    return V
+
+def _embed_call(cli, texts):
+    try:
+        r = cli.embeddings.create(model=OPENAI_MODEL, input=texts, dimensions=OPENAI_DIM,
+                                  encoding_format="base64")
+    except Exception:
+        return None
+    return _unit_rows(r.data)
+
 def _oai_embed(texts, db_path=None):  # SAME as search_module
+    """Embed texts in OAI_BATCH-sized requests.
+    
+    Returns (V, ok): V has one unit row per text, ok marks the rows whose batch succeeded.
+    Returns None if every batch failed.
+    """
     if not texts:
         return None
         
     cli = _cli()
     
-    # parallel microbatches for large requests
-    if len(texts) > 32:
-        batch_size = 32
-        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
-        
-        def _embed_batch(batch):
-            def _call():
-                return cli.embeddings.create(model=OPENAI_MODEL, input=batch, dimensions=OPENAI_DIM)
-            
-            with ThreadPoolExecutor(max_workers=1) as ex:
-                fut = ex.submit(_call)
-                try:
-                    r = fut.result(timeout=OAI_TIMEOUT)
-                    V = np.asarray([d.embedding for d in r.data], dtype=np.float32)
-                    V /= (np.linalg.norm(V, axis=1, keepdims=True) + 1e-9)
-                    return V
-                except (TimeoutError, Exception):
-                    return None
-        
-        # parallel execution of batches
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = [executor.submit(_embed_batch, batch) for batch in batches]
-            results = []
-            
-            for future in futures:
-                try:
-                    result = future.result(timeout=OAI_TIMEOUT * 1.5)
-                    if result is None:
-                        return None  # any batch fails = whole call fails
-                    results.append(result)
-                except:
-                    return None
-        
-        # concatenate all results
-        all_vecs = np.concatenate(results, axis=0)
-        return all_vecs
-    
-    # single batch - original logic
-    def _call():
-        return cli.embeddings.create(model=OPENAI_MODEL, input=texts, dimensions=OPENAI_DIM)
-    
-    with ThreadPoolExecutor(max_workers=1) as ex:
-        fut = ex.submit(_call)
+    # parallel batches only when the input exceeds one request
+    starts = range(0, len(texts), OAI_BATCH)
+    futures = [_EMBED_POOL.submit(_embed_call, cli, texts[i:i + OAI_BATCH]) for i in starts]
+    
+    # Wall-clock deadline: OAI_TIMEOUT per wave of _EMBED_WORKERS batches, so batches
+    # queued behind the first wave still get a full OAI_TIMEOUT once they start
+    waves = -(-len(futures) // _EMBED_WORKERS)
+    deadline = time.time() + OAI_TIMEOUT * waves
+    V = np.zeros((len(texts), OPENAI_DIM), dtype=np.float32)
+    ok = np.zeros(len(texts), dtype=bool)
+    for i, future in zip(starts, futures):
         try:
-            r = fut.result(timeout=OAI_TIMEOUT)
-        except (TimeoutError, Exception):
-            return None
-    
-    V = np.asarray([d.embedding for d in r.data], dtype=np.float32)
-    V /= (np.linalg.norm(V, axis=1, keepdims=True) + 1e-9)
-    return V
+            rows = future.result(timeout=max(0.0, deadline - time.time()))
+        except Exception:
+            # past the deadline: drop it if still queued so it doesn't spend an API call
+            # or hold the shared pool for the next query
+            future.cancel()
+            continue
+        if rows is not None:  # a failed batch only loses its own rows
+            V[i:i + len(rows)] = rows
+            ok[i:i + len(rows)] = True
+    
+    return (V, ok) if ok.any() else None
 
 def _adaptive_budget(scores, default=80):
     if len(scores) < 10: return min(len(scores), default)
@@ -252,14 +277,10 @@ def _extract_prf_terms(docs, query_tokens):
     term_scores = {}
     for doc_id, text, score in docs[:PRF_K]:
         doc_weight = 1.0 / (1.0 + abs(score)) if score < 0 else score
-        doc_tokens = tok(text)
-        tf_map = {}
-        for t in doc_tokens:
-            tf_map[t] = tf_map.get(t, 0) + 1
+        # Filter before counting so the C-level Counter only sees candidate terms
+        tf_map = Counter(t for t in tok(text) if len(t) >= 3 and t not in STOP and 
+                         not t.isdigit() and t not in query_tokens)
         for term, tf in tf_map.items():
-            if (len(term) < 3 or term in STOP or 
-                re.fullmatch(r"\d+", term) or term in query_tokens):
-                continue
             idf_est = 2.0 if tf <= 2 else 1.5 if tf <= 5 else 1.0
             term_score = doc_weight * tf * idf_est
             term_scores[term] = term_scores.get(term, 0) + term_score
@@ -291,7 +312,7 @@ def _has_factual_pattern(merged_text, query):
     boost = 0.0
     
     # GENERIC: Number proximity boost for queries containing numbers
-    query_numbers = re.findall(r'\b\d+\b', query)
+    query_numbers = _NUM_RE.findall(query)
     if query_numbers:
         # Look for any numbers from query within text
         for num in query_numbers:
@@ -299,7 +320,7 @@ def _has_factual_pattern(merged_text, query):
                 boost += 0.05
     
     # GENERIC: Year presence boost 
-    years = re.findall(r'\b\d{4}\b', query)
+    years = _YEAR_RE.findall(query)
     for year in years:
         if year in text_lower:
             boost += 0.05
@@ -327,10 +348,6 @@ def semantic_search(file_path, sentences, db_path="semantic_search.db"):
         print(f"Failed to ingest {file_path}: {e}")
         return []
     
-    con = _get_db_connection(kb_db_path)
-    cur = con.cursor()
-    
-    results = []
     seen = set()
     unique_sentences = []
     for sent in sentences:
@@ -338,11 +355,24 @@ def semantic_search(file_path, sentences, db_path="semantic_search.db"):
             seen.add(sent)
             unique_sentences.append(sent)
     
-    for sentence in unique_sentences:
-        sentence_results = _search_single_sentence(sentence, file_uid, file_path, cur, con, kb_db_path)
-        results.append(sentence_results)
+    con = _get_db_connection(kb_db_path)
+    cur = con.cursor()
     
-    con.close()
+    try:
+        # S1 per sentence: FTS + PRF + dedup + cache lookup (CPU-bound, so run serially)
+        retrieved = [_retrieve_candidates(sentence, file_uid, file_path, cur, con)
+                     for sentence in unique_sentences]
+        
+        # S2: ONE embedding call for every query and uncached doc across all sentences
+        cands = [cand for out, cand in retrieved if out is None]
+        new_rows = _embed_candidates(cands) if cands else []
+        
+        results = [out if out is not None else _rank_candidates(cand) for out, cand in retrieved]
+        
+        # One write + commit (one fsync) for the whole batch, after ranking
+        _store_embeddings(con, new_rows)
+    finally:
+        con.close()
     return results
 
 # PRF CONFIG (copied from search_module)
@@ -351,23 +381,31 @@ PRF_M = int(os.getenv("PRF_M", "20"))  # expansion terms (slightly richer)
 PRF_ALPHA = float(os.getenv("PRF_ALPHA", "0.7"))  # original query weight
 K_SQL2 = int(os.getenv("K_SQL2", str(K_SQL + 300)))  # second pass limit (more generous)
 
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
 def _jaccard_dedup(texts, scores, threshold=JACCARD_THRESHOLD):
     """ENHANCED: Remove near-duplicate texts using Jaccard similarity (ace code)"""
     if len(texts) <= 1:
         return list(range(len(texts)))
     
-    word_sets = [set(tok(t)) for t in texts]
+    # Packed token bitsets: one bit per distinct token, so popcounts give exact set sizes
+    vocab = {}
+    cols = [[vocab.setdefault(w, len(vocab)) for w in set(tok(t))] for t in texts]
+    M = np.zeros((len(texts), len(vocab)), dtype=bool)
+    for i, c in enumerate(cols):
+        M[i, c] = True
+    sigs = np.packbits(M, axis=1)
+    card = M.sum(axis=1)
+    
+    # All pairwise |A & B| at once; |A | B| follows from the cardinalities
+    inter = _POPCOUNT8[sigs[:, None, :] & sigs[None, :, :]].sum(axis=2, dtype=np.int64)
+    jaccard = inter / np.maximum(1, card[:, None] + card[None, :] - inter)
+    
     order = np.argsort(-np.asarray(scores))
     keep = []
     
     for i in order:
-        should_keep = True
-        for j in keep:
-            jaccard = len(word_sets[i] & word_sets[j]) / max(1, len(word_sets[i] | word_sets[j]))
-            if jaccard >= threshold:
-                should_keep = False
-                break
-        if should_keep:
+        if not keep or not (jaccard[i, keep] >= threshold).any():
             keep.append(i)
     
     return keep
@@ -376,7 +414,7 @@ def _compute_boost_features(texts, query):
     """ENHANCED: Compute boost features for post-fusion enhancement (ace code)"""
     qt = [t for t in tok(query) if t not in STOP]
     qs = set(qt)
-    qnums = set(re.findall(r'\d+', ' '.join(qt)))
+    qnums = set(_DIGITS_RE.findall(' '.join(qt)))
     phrases = {' '.join(qt[i:i+n]) for n in (2, 3) for i in range(len(qt)-n+1)} or {''}
     
     jaccard_scores, phrase_scores, digit_scores = [], [], []
@@ -393,12 +431,13 @@ def _compute_boost_features(texts, query):
         phrase_scores.append(sum(1 for p in phrases if p and p in s) / max(1, len(phrases)))
         
         # Digit matching
-        digit_scores.append(1 if qnums & set(re.findall(r'\d+', s)) else 0)
+        digit_scores.append(1 if qnums & set(_DIGITS_RE.findall(s)) else 0)
     
     # Normalize features
     def normalize(arr):
         arr = np.asarray(arr, float)
-        return (arr - np.min(arr)) / (np.ptp(arr) + 1e-9)
+        lo, hi = arr.min(), arr.max()
+        return (arr - lo) / (hi - lo + 1e-9)
     
     return normalize(jaccard_scores), normalize(phrase_scores), normalize(digit_scores)
 
@@ -413,8 +452,16 @@ def _compute_rank_correlation(bm25_ranks, embed_ranks):
     correlation = 1 - (6 * sum_d_sq) / (n * (n**2 - 1))
     return correlation
 
-def _search_single_sentence(q, file_uid, file_path, cur, cache_con, db_path=None):
-    """Search logic with PRF, adaptive budget, and speed optimizations"""
+def _decode_vec(blob):
+    """Cached doc vectors are stored as fp16"""
+    return np.frombuffer(blob, dtype=np.float16)
+
+def _retrieve_candidates(q, file_uid, file_path, cur, cache_con):
+    """S1: BM25 + PRF + dedup, then resolve cached doc vectors.
+    
+    Returns (out, None) when the sentence is already answered without embeddings,
+    else (None, cand) with the state _embed_candidates and _rank_candidates need.
+    """
     t_all = time.time()
     version = kb_store.VERSION_KEY
     
@@ -434,7 +481,7 @@ def _search_single_sentence(q, file_uid, file_path, cur, cache_con, db_path=None
     if not rows:
         if kb_config.DEBUG:
             print(f"LAT | S1_sql={bm25_ms}ms | 0 hits")
-        return []
+        return [], None
 
     # PRF - RESTORE THIS LOGIC
     initial_docs = [(span_id, text, 1.0/(1.0+raw_score)) for span_id, text, raw_score, _ in rows]
@@ -482,16 +529,17 @@ def _search_single_sentence(q, file_uid, file_path, cur, cache_con, db_path=None
         ids = [ids[k] for k in keep_indices]
         texts = [texts[k] for k in keep_indices]
         text_hashes = [text_hashes[k] for k in keep_indices]
-        bnorm = [bnorm[k] for k in keep_indices]
+        bnorm = bnorm[keep_indices]
 
     # Skip embedding for pure numeric queries
-    nums = [t for t in tok(q) if re.fullmatch(r"\d{3,4}", t)]
-    words = [t for t in tok(q) if t not in STOP and not re.fullmatch(r"\d{3,4}", t)]
+    q_toks = tok(q)
+    nums = [t for t in q_toks if _CODE_RE.fullmatch(t)]
+    words = [t for t in q_toks if t not in STOP and not _CODE_RE.fullmatch(t)]
     if len(nums) > 0 and len(words) == 0:
         out = [{"file_uid": file_uid, "file_path": file_path, "chunk_id": ids[j], "score": float(bnorm[j]), 
                 "snippet": _snippet(texts[j], q), "rank_stage": "S1"} 
                for j in range(min(K_FINAL, len(ids)))]
-        return out
+        return out, None
 
     # Use adaptive budget for rerank pool, but cap at available candidates
     adaptive_budget = _adaptive_budget(initial_scores)
@@ -502,14 +550,12 @@ def _search_single_sentence(q, file_uid, file_path, cur, cache_con, db_path=None
     texts = texts[:rerank_pool]
     text_hashes = text_hashes[:rerank_pool]
 
-    # S2: SINGLE OpenAI call
+    # S2 timing starts at the cache lookup
     t2 = time.time()
     
-    embed_texts = texts  # Use full texts, not tiered
-    
     # Batch check persistent cache for all docs at once
-    sims_o = [0.0] * len(ids)
-    need_idx, need_texts, need_hashes = [], [], []
+    need_texts, need_hashes = [], []
+    cache_map = {}
     
     if text_hashes:
         # Single SELECT for all hashes
@@ -518,9 +564,9 @@ def _search_single_sentence(q, file_uid, file_path, cur, cache_con, db_path=None
             f"SELECT text_hash, vector FROM embeddings WHERE text_hash IN ({placeholders}) AND model=? AND dim=? AND version=?",
             text_hashes + [OPENAI_MODEL, OPENAI_DIM, version]
         ).fetchall()
-        cache_map = {row[0]: np.frombuffer(row[1], dtype=np.float32) for row in cache_rows}
+        cache_map = {row[0]: _decode_vec(row[1]) for row in cache_rows}
         
-        for i, (text_hash, embed_text) in enumerate(zip(text_hashes, embed_texts)):
+        for text_hash, embed_text in zip(text_hashes, texts):  # full texts, not tiered
             cached_v = cache_map.get(text_hash)
             if cached_v is None:
                 cached_v = OAI_D_CACHE.get(("d", text_hash, OPENAI_MODEL, OPENAI_DIM))
@@ -528,82 +574,108 @@ def _search_single_sentence(q, file_uid, file_path, cur, cache_con, db_path=None
             if cached_v is not None:
                 cache_map[text_hash] = cached_v  # ensure it's in cache_map for query dot product
             else:
-                need_idx.append(i)
                 need_texts.append(embed_text)
                 need_hashes.append(text_hash)
     
-    # SINGLE combined embedding call: [query] + need_texts  
-    embed_input = [q] + need_texts
-    V = _oai_embed(embed_input) if embed_input else None
+    return None, {
+        "q": q, "file_uid": file_uid, "file_path": file_path,
+        "ids": ids, "texts": texts, "text_hashes": text_hashes, "bnorm": bnorm,
+        "cache_map": cache_map, "need_texts": need_texts, "need_hashes": need_hashes,
+        "rerank_pool": rerank_pool, "t_all": t_all, "t2": t2, "qv": None,
+    }
+
+def _embed_candidates(cands):
+    """S2: ONE combined embedding call for all queries + uncached docs; fills each cand in place.
     
-    if V is not None:
-        qv = V[0]  # query vector
-        
-        # Batch store new doc vectors
-        if need_idx:
-            new_cache_data = []
-            for j, (i, text_hash) in enumerate(zip(need_idx, need_hashes)):
-                dv = V[1 + j]  # doc vectors start at index 1
-                cache_map[text_hash] = dv
-                OAI_D_CACHE.put(("d", text_hash, OPENAI_MODEL, OPENAI_DIM), dv)
-                new_cache_data.append((text_hash, OPENAI_MODEL, OPENAI_DIM, version, dv.tobytes(), time.time()))
-            
-            # Single executemany + commit for all new vectors
-            if new_cache_data:
-                cache_con.executemany("INSERT OR REPLACE INTO embeddings VALUES (?,?,?,?,?,?)", new_cache_data)
-                cache_con.commit()
-        
-        # Compute similarities using cached vectors
-        for i, text_hash in enumerate(text_hashes):
-            dv = cache_map.get(text_hash)
-            if dv is not None:
-                sims_o[i] = float(dv @ qv)
-    else:
+    A cand gets qv only if its query and all its uncached docs were embedded; the rest keep
+    qv=None (BM25-only). Returns the new embeddings rows for _store_embeddings, so callers
+    can commit once at the end.
+    """
+    version = kb_store.VERSION_KEY
+    
+    # Docs shared between sentences are embedded once
+    pending = {}
+    for cand in cands:
+        for text_hash, text in zip(cand["need_hashes"], cand["need_texts"]):
+            pending.setdefault(text_hash, text)
+    
+    # SINGLE combined embedding call: queries + pending doc texts
+    embed_input = [cand["q"] for cand in cands] + list(pending.values())
+    embedded = _oai_embed(embed_input)
+    if embedded is None:
+        return []  # cands keep qv=None -> BM25-only fallback
+    V, ok = embedded
+    
+    # Batch store new doc vectors (doc vectors start after the queries); failed batches are skipped.
+    # Doc vectors are kept as fp16 everywhere so scores don't depend on cache state;
+    # unit-norm cosines lose ~1e-3 at most. D is widened back to fp32 for the GEMV.
+    # Rows of one contiguous pool are bound to sqlite as memoryviews, so no per-row tobytes() copy.
+    pool = np.ascontiguousarray(V[len(cands):], dtype=np.float16)
+    now = time.time()
+    new_vecs = {}
+    new_cache_data = []
+    for text_hash, dv, got in zip(pending, pool, ok[len(cands):]):
+        if not got:
+            continue
+        new_vecs[text_hash] = dv
+        OAI_D_CACHE.put(("d", text_hash, OPENAI_MODEL, OPENAI_DIM), dv)
+        new_cache_data.append((text_hash, OPENAI_MODEL, OPENAI_DIM, version, memoryview(dv), now))
+    
+    for qi, cand in enumerate(cands):
+        if not ok[qi] or any(text_hash not in new_vecs for text_hash in cand["need_hashes"]):
+            continue  # missing a vector -> qv stays None, BM25-only fallback for this sentence
+        cand["qv"] = V[qi]
+        for text_hash in cand["need_hashes"]:
+            cand["cache_map"][text_hash] = new_vecs[text_hash]
+    
+    return new_cache_data
+
+def _store_embeddings(cache_con, rows):
+    """Single executemany + commit for all new vectors"""
+    if not rows:
+        return
+    cache_con.executemany("INSERT OR REPLACE INTO embeddings VALUES (?,?,?,?,?,?)", rows)
+    cache_con.commit()
+
+def _rank_candidates(cand):
+    """S3: cosine rerank, RRF fusion, co-mention boost and vector-MMR"""
+    q, file_uid, file_path = cand["q"], cand["file_uid"], cand["file_path"]
+    ids, texts, text_hashes, bnorm = cand["ids"], cand["texts"], cand["text_hashes"], cand["bnorm"]
+    cache_map, qv = cand["cache_map"], cand["qv"]
+    
+    if qv is None:
         # Embedding failed, use BM25 only
         out = [{"file_uid": file_uid, "file_path": file_path, "chunk_id": ids[j], "score": float(bnorm[j]),
                 "snippet": _snippet(texts[j], q), "rank_stage": "S1_embed_fail"} 
                for j in range(min(K_FINAL, len(ids)))]
         return out
     
+    # Stack doc vectors once; one GEMV for all query similarities
+    D = np.empty((len(text_hashes), OPENAI_DIM), dtype=np.float32)
+    for i, text_hash in enumerate(text_hashes):
+        D[i] = cache_map[text_hash]
+    sims_o = (D @ qv).tolist()
+    
     # RRF Fusion with ADAPTIVE embedding weight
-    onorm = _minmax(sims_o) if any(sims_o) else [0.0] * len(ids)
+    onorm = _minmax(sims_o) if any(sims_o) else np.zeros(len(ids))
     sims_std = np.std(sims_o) if sims_o else 0.0
     
-    # Adaptive embedding weight based on BM25-embedding rank correlation
-    bm25_ranks = list(range(len(ids)))
-    embed_pairs = [(i, sims_o[i]) for i in range(len(ids))]
-    embed_pairs.sort(key=lambda x: -x[1])
-    embed_ranks = [0] * len(ids)
-    for rank, (idx, _) in enumerate(embed_pairs):
-        embed_ranks[idx] = rank
-    
     # Set embedding weight
     embedding_weight = 1.0/(1.0 + np.exp(-(sims_std - 0.008)/0.004))
     embedding_weight = 0.6 + 0.4*embedding_weight
     
-    # RRF scoring
-    embed_pairs = [(i, onorm[i] * embedding_weight) for i in range(len(ids))]
-    embed_pairs.sort(key=lambda x: -x[1])
-    embed_ranks = [0] * len(ids)
-    for rank, (idx, _) in enumerate(embed_pairs):
-        embed_ranks[idx] = rank
-    
-    rrf_scores = []
-    for j in range(len(ids)):
-        bm25_rrf = 1.0 / (RRF_K + bm25_ranks[j])
-        embed_rrf = 1.0 / (RRF_K + embed_ranks[j])
-        rrf_score = bm25_rrf + embed_rrf
-        rrf_scores.append(rrf_score)
+    # RRF scoring (stable argsort keeps index order on ties, like the old list sort)
+    n = len(ids)
+    bm25_ranks = np.arange(n)
+    embed_order = np.argsort(-(onorm * embedding_weight), kind="stable")
+    embed_ranks = np.empty(n, dtype=np.intp)
+    embed_ranks[embed_order] = np.arange(n)
+    rrf_scores = 1.0 / (RRF_K + bm25_ranks) + 1.0 / (RRF_K + embed_ranks)
     
     # POST-FUSION CO-MENTION BOOST (restore this)
     jaccard_boost, phrase_boost, digit_boost = _compute_boost_features(texts, q)
-    
-    final_scores = []
-    for i in range(len(rrf_scores)):
-        base = rrf_scores[i]
-        jacc, phrb, digb = jaccard_boost[i], phrase_boost[i], digit_boost[i]
-        co_mention = 0.4*jacc + 0.3*phrb + 0.1*digb
-        final_scores.append(base * (1 + co_mention))
+    co_mention = 0.4*jaccard_boost + 0.3*phrase_boost + 0.1*digit_boost
+    final_scores = (rrf_scores * (1 + co_mention)).tolist()
     
     # Sort by enhanced scores
     scored_docs = list(zip(ids, texts, final_scores))
@@ -614,48 +686,36 @@ def _search_single_sentence(q, file_uid, file_path, cur, cache_con, db_path=None
     vector_coverage = nonzero_sims / len(ids) if ids else 0.0
     
     if len(scored_docs) > K_FINAL and vector_coverage >= 0.90:  # REVERT: Back to 0.90
-        mmr_selected = []
-        remaining = list(scored_docs)
+        # Work in scored order so argmax ties resolve to the higher fused score
+        id_to_idx = {doc_id: i for i, doc_id in enumerate(ids)}
+        perm = np.fromiter((id_to_idx[doc_id] for doc_id, _, _ in scored_docs), dtype=np.intp, count=len(scored_docs))
+        rel = np.asarray(sims_o)[perm]
+        Dp = D[perm]
+        S = Dp @ Dp.T  # pairwise doc similarities (rows of D are unit vectors)
         
         # Always take top result
-        mmr_selected.append(remaining.pop(0))
+        picks = [0]
+        remaining_mask = np.ones(len(scored_docs), dtype=bool)
+        remaining_mask[0] = False
+        max_sim = np.maximum(0.0, S[:, 0])  # running max similarity to selected set
         
         # Vector-MMR selection with λ=0.7
         lambda_mmr = 0.7  # balance relevance vs diversity
-        while len(mmr_selected) < K_FINAL and remaining:
-            best_idx = 0
-            best_score = -float('inf')
-            
-            for i, (doc_id, text, rel_score) in enumerate(remaining):
-                doc_hash = text_hashes[ids.index(doc_id)] if doc_id in ids else _text_hash(text)
-                doc_vec = cache_map.get(doc_hash)
-                
-                if doc_vec is not None:
-                    relevance = float(doc_vec @ qv)
-                    
-                    # Max similarity with already selected
-                    max_sim = 0.0
-                    for sel_id, sel_text, _ in mmr_selected:
-                        sel_hash = text_hashes[ids.index(sel_id)] if sel_id in ids else _text_hash(sel_text)
-                        sel_vec = cache_map.get(sel_hash)
-                        if sel_vec is not None:
-                            sim = float(doc_vec @ sel_vec)
-                            max_sim = max(max_sim, sim)
-                    
-                    # MMR score: λ * relevance - (1-λ) * max_similarity
-                    mmr_score = lambda_mmr * relevance - (1 - lambda_mmr) * max_sim
-                    if mmr_score > best_score:
-                        best_score = mmr_score
-                        best_idx = i
-            
-            mmr_selected.append(remaining.pop(best_idx))
+        while len(picks) < K_FINAL and remaining_mask.any():
+            # MMR score: λ * relevance - (1-λ) * max_similarity
+            mmr_scores = lambda_mmr * rel - (1 - lambda_mmr) * max_sim
+            pick = int(np.argmax(np.where(remaining_mask, mmr_scores, -np.inf)))
+            picks.append(pick)
+            remaining_mask[pick] = False
+            max_sim = np.maximum(max_sim, S[:, pick])
         
+        mmr_selected = [scored_docs[p] for p in picks]
         final_docs = mmr_selected
     else:
         final_docs = scored_docs[:K_FINAL]
     
     # Build output
-    oai_ms = round((time.time() - t2) * 1000, 2)
+    oai_ms = round((time.time() - cand["t2"]) * 1000, 2)
     out = []
     for i, (doc_id, text, final_score) in enumerate(final_docs):
         out.append({
@@ -667,11 +727,11 @@ def _search_single_sentence(q, file_uid, file_path, cur, cache_con, db_path=None
             "rank_stage": "S3_MMR" if vector_coverage >= 0.90 else "S3"
         })
     
-    cache_hits = len(ids) - len(need_idx) if need_idx else len(ids)
+    cache_hits = len(ids) - len(cand["need_hashes"])
     cache_pct = round(100 * cache_hits / len(ids), 1) if ids else 0
     
     if kb_config.DEBUG:
-        print(f"LAT | docs={len(out)} | rerank={rerank_pool} | embeds={nonzero_sims}/{len(ids)} | embed_batch={len(need_texts)} | cache={cache_pct}% | vec_cov={vector_coverage:.1%} | {round((time.time()-t_all)*1000,1)}ms")
+        print(f"LAT | docs={len(out)} | rerank={cand['rerank_pool']} | embeds={nonzero_sims}/{len(ids)} | embed_batch={len(cand['need_texts'])} | cache={cache_pct}% | vec_cov={vector_coverage:.1%} | {round((time.time()-cand['t_all'])*1000,1)}ms")
     return out
 
 __all__ = ["semantic_search"]
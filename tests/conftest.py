@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# kb_config reads KB_DIR and semantic_search checks OPENAI_API_KEY at import time
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ["KB_DIR"] = tempfile.mkdtemp(prefix="kb-fusion-tests-")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,76 @@
+import base64
+import random
+import threading
+import time
+import types
+import zlib
+
+import numpy as np
+import pytest
+
+import semantic_search as ss
+
+WORDS = ["reset", "password", "account", "billing", "invoice", "login", "security", "token"]
+
+
+class FakeEmbeddings:
+    """Deterministic stand-in for client.embeddings with an optional delay and failing inputs."""
+
+    def __init__(self, delay=0.0, fail_on=()):
+        self.delay, self.fail_on = delay, set(fail_on)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def create(self, model, input, dimensions, encoding_format=None):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        if self.fail_on.intersection(input):
+            raise RuntimeError("429 Too Many Requests")
+        data = []
+        for text in input:
+            rng = np.random.default_rng(zlib.crc32(text.encode()))
+            vec = rng.standard_normal(dimensions).astype(np.float32)
+            data.append(types.SimpleNamespace(embedding=base64.b64encode(vec.tobytes()).decode()))
+        return types.SimpleNamespace(data=data)
+
+
+@pytest.fixture
+def doc(tmp_path, request):
+    # Fresh paragraphs per test so no vector is already in the embedding cache
+    rnd = random.Random(request.node.name)
+    vocab = WORDS + [f"{request.node.name[:8]}{i}" for i in range(200)]
+    paras = [" ".join(rnd.choice(vocab) for _ in range(rnd.randint(40, 90))) + "." for _ in range(200)]
+    path = tmp_path / "doc.txt"
+    path.write_text("\n".join(paras), encoding="utf-8")
+    return str(path)
+
+
+def _use(monkeypatch, embeddings, batch):
+    monkeypatch.setattr(ss, "_client", types.SimpleNamespace(embeddings=embeddings))
+    monkeypatch.setattr(ss, "OAI_BATCH", batch)
+
+
+def test_slow_batches_beyond_first_wave_are_ranked(doc, monkeypatch):
+    # Each call takes most of OAI_TIMEOUT, and there are more batches than pool workers,
+    # so later waves only finish if the deadline allows for their queue time
+    embeddings = FakeEmbeddings(delay=0.2)
+    _use(monkeypatch, embeddings, batch=4)
+    monkeypatch.setattr(ss, "OAI_TIMEOUT", 0.3)
+
+    results = ss.semantic_search(doc, ["reset password account", "billing invoice login"])
+
+    assert embeddings.calls > ss._EMBED_WORKERS
+    assert all(results)
+    assert all(hit["rank_stage"].startswith("S3") for hits in results for hit in hits)
+
+
+def test_failed_batch_only_falls_back_for_its_sentence(doc, monkeypatch):
+    # One input per request, and only the first query's request fails
+    embeddings = FakeEmbeddings(fail_on={"reset password account"})
+    _use(monkeypatch, embeddings, batch=1)
+
+    failed, ranked = ss.semantic_search(doc, ["reset password account", "billing invoice login"])
+
+    assert failed and all(hit["rank_stage"] == "S1_embed_fail" for hit in failed)
+    assert ranked and all(hit["rank_stage"].startswith("S3") for hit in ranked)